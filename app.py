@@ -2,21 +2,23 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-import seaborn as sns
+from matplotlib.patches import Patch
 import os
-import tempfile
+import io
+import hashlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations, product
 
-import statsmodels.api as sm
-from statsmodels.formula.api import ols
-from statsmodels.stats.multicomp import pairwise_tukeyhsd
-
-from fpdf import FPDF
+# numba（kernels 模块）、seaborn、scipy、fpdf 导入较慢，放到用到它们的函数内部再导入
 
 # 中文字体路径（你必须上传到 GitHub）
 FONT_PATH = "SourceHanSansSC-Regular.otf"
+# 启动时检查一次字体文件，PDF 生成时直接复用
+HAS_CN_FONT = os.path.exists(FONT_PATH)
 
 # Matplotlib 中文设置
-if os.path.exists(FONT_PATH):
+if HAS_CN_FONT:
     plt.rcParams['font.sans-serif'] = ['Source Han Sans SC']
 else:
     plt.rcParams['font.sans-serif'] = ['SimHei']
@@ -24,59 +26,305 @@ else:
 plt.rcParams['axes.unicode_minus'] = False
 
 
-# 自动识别因素列（非数字）与数值列（最后一个数字列）
-def detect_factors(df):
-    numeric_cols = df.select_dtypes(include=[np.number]).columns.tolist()
+# 数据量超过该行数时，箱线图改为先在 pandas 中计算统计量再绘制
+BOXPLOT_MAX_ROWS = 50_000
+# 每组最多绘制的离群点数量（保留最极端的那些）
+MAX_FLIERS = 50
+
+
+# 自动识别因素列（非数字）与数值列（最后一个数字列），
+# 同时一次性转换为数组：y 为 float64，每个因素为 int32 水平编码及对应的水平值。
+# 缓存键是上传文件内容的摘要 data_key：Streamlit 对大 DataFrame 只抽样哈希，
+# 不能用来区分只改了少数单元格的两次上传，因此 _df 不参与哈希
+@st.cache_data(show_spinner=False)
+def detect_factors(_df, data_key):
+    numeric_cols = _df.select_dtypes(include=[np.number]).columns.tolist()
     if len(numeric_cols) == 0:
-        return [], None
+        return [], None, None, {}, {}
     value_col = numeric_cols[-1]             # 最后一列作为因变量
-    factor_cols = df.columns.tolist()
+    factor_cols = _df.columns.tolist()
     factor_cols.remove(value_col)
-    return factor_cols, value_col
-
-
-# 运行 ANOVA
-def run_anova(df, factors, value_col):
-    if len(factors) == 1:
-        formula = f"{value_col} ~ C({factors[0]})"
-    elif len(factors) == 2:
-        f1, f2 = factors
-        formula = f"{value_col} ~ C({f1}) * C({f2})"
-    else:
-        f1, f2, f3 = factors[:3]
-        formula = f"{value_col} ~ C({f1}) * C({f2}) * C({f3})"
-
-    model = ols(formula, data=df).fit()
-    anova_table = sm.stats.anova_lm(model, typ=2)
-    return anova_table, model
-
-
-# Tukey 事后检验
-def tukey_test(df, factor, value_col):
-    return pairwise_tukeyhsd(df[value_col], df[factor])
 
+    # copy=True：pandas 返回的可能是只读视图，而 kernels 的显式签名要求可写数组
+    y = _df[value_col].to_numpy(dtype=np.float64, copy=True)
+    codes, uniques = {}, {}
+    for f in factor_cols:
+        c, u = pd.factorize(_df[f], sort=True)
+        codes[f], uniques[f] = c.astype(np.int32), list(u)
+
+    # 剔除数值或任一因素缺失的行（缺失因素编码为 -1），并重新压缩编码
+    keep = ~np.isnan(y)
+    for c in codes.values():
+        keep &= c >= 0
+    if not keep.all():
+        y = y[keep]
+        for f in factor_cols:
+            present, inverse = np.unique(codes[f][keep], return_inverse=True)
+            codes[f] = inverse.astype(np.int32)
+            uniques[f] = [uniques[f][i] for i in present]
+    return factor_cols, value_col, y, codes, uniques
+
+
+# 读取 Excel（按文件内容缓存，避免每次重跑都重新解析）
+@st.cache_data(show_spinner=False)
+def load_excel(file_bytes):
+    # 优先使用 calamine（Rust 实现，解析速度快很多），不可用时退回默认引擎
+    try:
+        df = pd.read_excel(io.BytesIO(file_bytes), engine="calamine")
+    except (ImportError, ValueError):
+        df = pd.read_excel(io.BytesIO(file_bytes))
+
+    # 非数值列（因素）读入后立即转为 category，后续分组和编码都走整数编码；
+    # 数值列保持 float64，不做降精度
+    factor_cols = df.select_dtypes(exclude=[np.number]).columns
+    return df.astype({c: "category" for c in factor_cols})
+
+
+# 拟合结果：只保留后续需要的残差信息
+AnovaFit = namedtuple("AnovaFit", ["ssr", "df_resid", "mse_resid"])
+
+
+# 各项（主效应或交互项）的列说明：截距列之后依次排列每一项的哑变量列
+def _design_columns(n_levels, terms):
+    col_levels = [[-1] * len(n_levels)]
+    term_idx = {}
+    for t in terms:
+        start = len(col_levels)
+        for levels in product(*(range(1, n_levels[i]) for i in t)):
+            spec = [-1] * len(n_levels)
+            for i, lvl in zip(t, levels):
+                spec[i] = lvl
+            col_levels.append(spec)
+        term_idx[t] = np.arange(start, len(col_levels))
+    return np.array(col_levels, dtype=np.int32), term_idx
+
+
+# 最小二乘拟合，返回残差平方和与设计矩阵的秩
+def _rss(X, y):
+    import scipy.linalg
+
+    # 有空单元格时设计矩阵秩亏，需显式给出相对容差，否则秩会被高估
+    coef, _, rank, _ = scipy.linalg.lstsq(X, y, cond=1e-10, lapack_driver="gelsy")
+    resid = y - X @ coef
+    return float(resid @ resid), rank
+
+
+# 运行 ANOVA（Type II 平方和，直接用 lstsq 计算，结果格式与 anova_lm 一致）。
+# 以 data_key（上传文件摘要）和因素作为缓存键，数组本身不参与哈希
+@st.cache_data(show_spinner=False)
+def run_anova(_y, _codes, factors, data_key):
+    from scipy import stats
+    from kernels import build_design
+
+    factors = factors[:3]
+    n_levels = [int(_codes[f].max()) + 1 for f in factors]
+
+    # 全部主效应与交互项，例如 (0,), (1,), (0, 1)
+    terms = [t for r in range(1, len(factors) + 1)
+             for t in combinations(range(len(factors)), r)]
+    col_levels, term_idx = _design_columns(n_levels, terms)
+    X = build_design(np.vstack([_codes[f] for f in factors]), col_levels)
+
+    # 每个项集合只构造一次设计矩阵并拟合一次（全模型直接用 X，不复制）
+    fits = {frozenset(terms): _rss(X, _y)}
+
+    def fit(ts):
+        key = frozenset(ts)
+        if key not in fits:
+            cols = np.concatenate([[0]] + [term_idx[t] for t in terms if t in key])
+            fits[key] = _rss(X[:, cols], _y)
+        return fits[key]
+
+    ssr, rank = fits[frozenset(terms)]
+    df_resid = len(_y) - rank
+    mse = ssr / df_resid
+
+    rows = {}
+    for t in terms:
+        # Type II：在不含该项及其高阶交互的模型上加入该项
+        others = [u for u in terms if not set(t) <= set(u)]
+        ssr_without, rank_without = fit(others)
+        ssr_with, rank_with = fit(others + [t])
+        ss = ssr_without - ssr_with
+        ddf = rank_with - rank_without
+        F = (ss / ddf) / mse if ddf > 0 else np.nan
+        p = stats.f.sf(F, ddf, df_resid) if ddf > 0 else np.nan
+        name = ":".join(f"C({factors[i]})" for i in t)
+        rows[name] = [ss, float(ddf), F, p]
+    rows["Residual"] = [ssr, float(df_resid), np.nan, np.nan]
+
+    anova_table = pd.DataFrame.from_dict(
+        rows, orient="index", columns=["sum_sq", "df", "F", "PR(>F)"]
+    )
+    return anova_table, AnovaFit(ssr, df_resid, mse)
+
+
+# Tukey 检验结果，summary() 输出与 statsmodels 相同样式的文本表
+class TukeyResult:
+    def __init__(self, groups, group1, group2, meandiffs, pvalues,
+                 lower, upper, reject, alpha=0.05):
+        self.groups = groups
+        self.group1 = group1
+        self.group2 = group2
+        self.meandiffs = meandiffs
+        self.pvalues = pvalues
+        self.lower = lower
+        self.upper = upper
+        self.reject = reject
+        self.alpha = alpha
+
+    def summary(self):
+        header = ["group1", "group2", "meandiff", "p-adj", "lower", "upper", "reject"]
+        rows = [
+            [str(self.groups[i]), str(self.groups[j]), f"{d:.4f}", f"{p:.4f}",
+             f"{lo:.4f}", f"{hi:.4f}", str(bool(r))]
+            for i, j, d, p, lo, hi, r in zip(
+                self.group1, self.group2, self.meandiffs, self.pvalues,
+                self.lower, self.upper, self.reject
+            )
+        ]
+        widths = [max(len(row[c]) for row in [header] + rows) for c in range(len(header))]
+        lines = [" ".join(cell.rjust(w) for cell, w in zip(row, widths))
+                 for row in [header] + rows]
+        width = len(lines[0])
+        title = f"Multiple Comparison of Means - Tukey HSD, FWER={self.alpha:.2f}"
+        return "\n".join([title, "=" * width, lines[0], "-" * width]
+                         + lines[1:] + ["-" * width])
+
+
+# Tukey 事后检验：所有因素共用一次分组汇总，误差均方直接复用 ANOVA 全模型的残差。
+# 缓存键同 run_anova，其余参数都由上传内容决定，不参与哈希
+@st.cache_data(show_spinner=False)
+def tukey_test(_y, _codes, _uniques, factors, _model, data_key, alpha=0.05):
+    from numba import get_num_threads
+    from scipy import stats
+    from kernels import groupstats, tukey_kernel
+
+    n_levels = np.array([len(_uniques[f]) for f in factors], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(n_levels)[:-1]])
+    sums, counts = groupstats(
+        _y, np.vstack([_codes[f] for f in factors]), offsets, int(n_levels.sum()),
+        max(1, min(get_num_threads(), len(_y)))
+    )
+    all_means = sums / counts
+
+    results = []
+    for f, k, start in zip(factors, n_levels, offsets):
+        means = all_means[start:start + k]
+        group_counts = counts[start:start + k].astype(np.float64)
+        q_crit = stats.studentized_range.ppf(1 - alpha, k, _model.df_resid)
+        group1, group2, meandiffs, lower, upper, q_stat, reject = tukey_kernel(
+            means, group_counts, _model.mse_resid, q_crit
+        )
+        pvalues = stats.studentized_range.sf(q_stat, k, _model.df_resid)
+        results.append(TukeyResult(np.asarray(_uniques[f]), group1, group2, meandiffs,
+                                   pvalues, lower, upper, reject, alpha))
+    return results
+
+
+# 单组箱线图统计量（与 matplotlib 默认的 1.5 倍 IQR 须线规则一致）
+def _box_stats(values):
+    q1, med, q3 = np.percentile(values, [25, 50, 75])
+    iqr = q3 - q1
+    lo, hi = q1 - 1.5 * iqr, q3 + 1.5 * iqr
+    inside = values[(values >= lo) & (values <= hi)]
+    fliers = values[(values < lo) | (values > hi)]
+    if len(fliers) > MAX_FLIERS:
+        # 只保留离中位数最远的离群点，并始终包含最小值和最大值，不缩小数据范围
+        idx = np.argsort(np.abs(fliers - med))[-(MAX_FLIERS - 2):]
+        idx = np.union1d(idx, [fliers.argmin(), fliers.argmax()])
+        fliers = fliers[idx]
+    return {
+        "med": med,
+        "q1": q1,
+        "q3": q3,
+        "whislo": inside.min() if len(inside) else q1,
+        "whishi": inside.max() if len(inside) else q3,
+        "fliers": fliers,
+    }
+
+
+# 大数据量箱线图：按组预先汇总，只把统计量交给 matplotlib
+def _aggregated_boxplot(ax, df, factors, value_col):
+    import seaborn as sns
+
+    keys = factors[:2]
+    data = df.dropna(subset=[value_col])
+    x_levels = data[keys[0]].cat.categories
+    hue_levels = data[keys[1]].cat.categories if len(keys) > 1 else [None]
+    width = 0.8 / len(hue_levels)
+    colors = sns.color_palette(n_colors=len(hue_levels))
+
+    stats_by_hue = {h: ([], []) for h in range(len(hue_levels))}
+    for key, values in data.groupby(keys, observed=True)[value_col]:
+        xi = x_levels.get_loc(key[0])
+        hi = hue_levels.get_loc(key[1]) if len(keys) > 1 else 0
+        box_stats, positions = stats_by_hue[hi]
+        box_stats.append(_box_stats(values.to_numpy(dtype=np.float64)))
+        positions.append(xi - 0.4 + width * (hi + 0.5))
+
+    for hi, (box_stats, positions) in stats_by_hue.items():
+        if box_stats:
+            ax.bxp(
+                box_stats,
+                positions=positions,
+                widths=width * 0.8,
+                patch_artist=True,
+                boxprops={"facecolor": colors[hi]},
+                medianprops={"color": "black"},
+                showfliers=True,
+                manage_ticks=False,
+            )
+
+    ax.set_xticks(range(len(x_levels)))
+    ax.set_xticklabels([str(x) for x in x_levels])
+    ax.set_xlabel(keys[0])
+    ax.set_ylabel(value_col)
+    if len(keys) > 1:
+        handles = [Patch(facecolor=c, label=str(h)) for c, h in zip(colors, hue_levels)]
+        ax.legend(handles=handles, title=keys[1])
+
+
+# 图像渲染为内存中的 PNG 字节
+def _render_png(fig):
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=150)
+    return buf.getvalue()
+
+
+# 绘图，返回渲染好的 PNG 字节（相同数据直接复用）。缓存的是字节而不是 Figure：
+# Figure 不是线程安全的，不能在多个会话之间共享。缓存键同 run_anova
+@st.cache_data(show_spinner=False, max_entries=8)
+def create_plots(_df, factors, value_col, data_key):
+    import seaborn as sns
 
-# 绘图
-def create_plots(df, factors, value_col):
     plots = []
 
+    # 因素列转为 category（只保留出现过的水平），分组走整数编码的快速路径
+    df = _df.astype({f: "category" for f in factors})
+    for f in factors:
+        df[f] = df[f].cat.remove_unused_categories()
+
     # 箱线图
-    fig1, ax1 = plt.subplots(figsize=(10, 6))
-    sns.boxplot(
-        data=df,
-        x=factors[0], 
-        y=value_col,
-        hue=factors[1] if len(factors) > 1 else None,
-        ax=ax1
-    )
+    fig1, ax1 = plt.subplots(figsize=(10, 6), layout="constrained")
+    if len(df) > BOXPLOT_MAX_ROWS:
+        _aggregated_boxplot(ax1, df, factors, value_col)
+    else:
+        sns.boxplot(
+            data=df,
+            x=factors[0], 
+            y=value_col,
+            hue=factors[1] if len(factors) > 1 else None,
+            ax=ax1
+        )
     ax1.set_title("箱线图")
     plt.xticks(rotation=25)
     plots.append(fig1)
 
     # 均值折线图
-    mean_df = df.groupby(factors)[value_col].mean().reset_index()
+    mean_df = df.groupby(factors, observed=True, sort=False, as_index=False)[value_col].mean()
 
-    fig2, ax2 = plt.subplots(figsize=(10, 6))
+    fig2, ax2 = plt.subplots(figsize=(10, 6), layout="constrained")
     if len(factors) == 1:
         sns.lineplot(data=mean_df, x=factors[0], y=value_col, marker="o", ax=ax2)
     else:
@@ -94,53 +342,74 @@ def create_plots(df, factors, value_col):
     plt.xticks(rotation=25)
     plots.append(fig2)
 
-    return plots
+    # 多线程并行渲染（Agg 编码 PNG 时会释放 GIL）；这些 Figure 只属于本次调用
+    with ThreadPoolExecutor(max_workers=len(plots)) as ex:
+        pngs = list(ex.map(_render_png, plots))
+
+    # 渲染完即从 pyplot 的全局图表管理中移除，避免每次重跑都残留
+    for fig in plots:
+        plt.close(fig)
+
+    return pngs
+
+
+# ANOVA 表转为文本：列固定，直接格式化数值，不经过 DataFrame.to_string
+def _format_anova_table(anova_table):
+    vals = anova_table[["sum_sq", "df", "F", "PR(>F)"]].to_numpy(dtype=np.float64)
+    names = [str(name) for name in anova_table.index]
+    width = max(len(name) for name in names)
+    lines = [f"{'':<{width}s} {'sum_sq':>12s} {'df':>6s} {'F':>10s} {'PR(>F)':>10s}"]
+    for name, (sq, d, F, p) in zip(names, vals):
+        # 残差行没有 F 和 p 值，留空
+        F_text = f"{F:10.3f}" if not np.isnan(F) else ""
+        p_text = f"{p:10.3e}" if not np.isnan(p) else ""
+        lines.append(f"{name:<{width}s} {sq:12.4f} {d:6.0f} {F_text:>10s} {p_text:>10s}")
+    return "\n".join(lines)
 
 
 # PDF 生成
-def generate_pdf(anova_table, tukey_text, plots):
+def generate_pdf(anova_table, tukey_text, plot_pngs):
+    from fpdf import FPDF
+    from fpdf.enums import XPos, YPos
+
     pdf = FPDF()
     pdf.add_page()
 
-    # 中文字体
-    if os.path.exists(FONT_PATH):
-        pdf.add_font("SourceHan", "", FONT_PATH, uni=True)
-        pdf.set_font("SourceHan", size=14)
+    # 中文字体（正文中含因素名等中文，表格文本也使用该字体）
+    if HAS_CN_FONT:
+        pdf.add_font("SourceHan", fname=FONT_PATH)
+        font = "SourceHan"
     else:
-        pdf.set_font("Arial", size=14)
+        font = "Arial"
+    pdf.set_font(font, size=14)
 
-    pdf.cell(0, 10, "方差分析报告（自动生成）", ln=True)
+    pdf.cell(0, 10, "方差分析报告（自动生成）", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
     pdf.ln(5)
 
     # ANOVA 表格
-    pdf.set_font("SourceHan" if os.path.exists(FONT_PATH) else "Arial", size=12)
-    pdf.cell(0, 8, "一、ANOVA 检验结果：", ln=True)
+    pdf.set_font(font, size=12)
+    pdf.cell(0, 8, "一、ANOVA 检验结果：", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
 
-    pdf.set_font("Arial", size=9)
-    for line in anova_table.to_string().split("\n"):
-        pdf.cell(0, 5, line, ln=True)
+    # 整块文本一次写入，而不是逐行 cell
+    pdf.set_font(font, size=9)
+    pdf.multi_cell(0, 5, _format_anova_table(anova_table), new_x=XPos.LMARGIN, new_y=YPos.NEXT)
 
     pdf.ln(5)
 
     # Tukey
-    pdf.set_font("SourceHan" if os.path.exists(FONT_PATH) else "Arial", size=12)
-    pdf.cell(0, 8, "二、Tukey 事后检验：", ln=True)
+    pdf.set_font(font, size=12)
+    pdf.cell(0, 8, "二、Tukey 事后检验：", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
 
-    pdf.set_font("Arial", size=9)
-    for line in tukey_text.split("\n"):
-        pdf.cell(0, 5, line, ln=True)
-
-    # 插入图像
-    for fig in plots:
-        temp = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-        fig.savefig(temp.name, dpi=150, bbox_inches="tight")
+    pdf.set_font(font, size=9)
+    pdf.multi_cell(0, 5, tukey_text, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
 
+    # 插入图像（create_plots 已渲染好的 PNG）
+    for png in plot_pngs:
         pdf.add_page()
-        pdf.image(temp.name, x=10, y=20, w=180)
+        pdf.image(io.BytesIO(png), x=10, y=20, w=180)
 
-    pdf_path = "anova_report.pdf"
-    pdf.output(pdf_path)
-    return pdf_path
+    # 直接返回字节，不落盘（也避免多个会话互相覆盖同一个文件）
+    return bytes(pdf.output())
 
 
 # Streamlit 界面
@@ -149,12 +418,15 @@ st.title("📊 自动 ANOVA 方差分析工具（1-3 因素）")
 uploaded = st.file_uploader("上传 Excel 文件", type=["xlsx", "xls"])
 
 if uploaded:
-    df = pd.read_excel(uploaded)
+    file_bytes = uploaded.getvalue()
+    # 文件内容摘要，作为下游各缓存函数的键
+    data_key = hashlib.sha1(file_bytes).hexdigest()
+    df = load_excel(file_bytes)
     st.success("文件读取成功！")
     st.dataframe(df.head())
 
     # 自动识别列
-    factors, value_col = detect_factors(df)
+    factors, value_col, y, codes, uniques = detect_factors(df, data_key)
     if not factors:
         st.error("未检测到因素列")
         st.stop()
@@ -162,28 +434,32 @@ if uploaded:
     st.info(f"识别到 {len(factors)} 个因素：{factors}\n数值列：{value_col}")
 
     # ANOVA
-    anova_table, model = run_anova(df, factors, value_col)
+    anova_table, model = run_anova(y, codes, factors, data_key)
     st.subheader("📌 ANOVA 结果")
     st.dataframe(anova_table)
 
     # Tukey
     st.subheader("📌 Tukey 事后检验")
     tukey_text = ""
-    for f in factors:
+    tukeys = tukey_test(y, codes, uniques, factors, model, data_key)
+    for f, tukey in zip(factors, tukeys):
         st.write(f"### 因素：{f}")
-        tukey = tukey_test(df, f, value_col)
         st.text(tukey.summary())
         tukey_text += f"\n\n因素：{f}\n{tukey.summary()}"
 
     # 图表
     st.subheader("📌 图表展示")
-    plots = create_plots(df, factors, value_col)
-    for fig in plots:
-        st.pyplot(fig)
+    plot_pngs = create_plots(df, factors, value_col, data_key)
+    for png in plot_pngs:
+        st.image(png)
 
     # PDF
     if st.button("📥 生成 PDF 报告"):
-        pdf_path = generate_pdf(anova_table, tukey_text, plots)
-        with open(pdf_path, "rb") as f:
-            st.download_button("点击下载 PDF", f, file_name="anova_report.pdf")
+        pdf_bytes = generate_pdf(anova_table, tukey_text, plot_pngs)
+        st.download_button(
+            "点击下载 PDF",
+            data=pdf_bytes,
+            file_name="anova_report.pdf",
+            mime="application/pdf"
+        )
 
@@ -0,0 +1,84 @@
+# Numba 计算核心。单独成模块：Streamlit 每次重跑都会重新执行 app.py，
+# 而模块只导入一次；显式签名在导入时即编译，cache=True 把编译结果写入
+# __pycache__，之后的进程直接加载，不再重复 JIT
+import numpy as np
+from numba import njit, prange
+
+
+# 构造设计矩阵：每一列由各因素要求的水平决定（-1 表示该列不涉及该因素），
+# 处理编码下列值为 1 当且仅当该行在所有涉及因素上都取到对应水平
+@njit("f8[:, ::1](i4[:, :], i4[:, :])", parallel=True, cache=True)
+def build_design(codes, col_levels):
+    n = codes.shape[1]
+    n_cols, n_factors = col_levels.shape
+    X = np.empty((n, n_cols))
+    for r in prange(n):
+        for c in range(n_cols):
+            v = 1.0
+            for f in range(n_factors):
+                lvl = col_levels[c, f]
+                if lvl >= 0 and codes[f, r] != lvl:
+                    v = 0.0
+                    break
+            X[r, c] = v
+    return X
+
+
+# 一次遍历 y 同时累计所有因素各水平的和与样本量（offsets 为各因素在结果中的起始位置）。
+# 按行分为 n_chunks 块并行，每块写各自的累加行，最后合并，避免并行写冲突
+@njit(
+    "Tuple((f8[::1], i8[::1]))(f8[:], i4[:, :], i8[:], i8, i8)",
+    parallel=True, cache=True, fastmath=True
+)
+def groupstats(y, codes, offsets, n_groups, n_chunks):
+    n_factors, n = codes.shape
+    chunk_sums = np.zeros((n_chunks, n_groups))
+    chunk_counts = np.zeros((n_chunks, n_groups), np.int64)
+    for ch in prange(n_chunks):
+        start = ch * n // n_chunks
+        stop = (ch + 1) * n // n_chunks
+        for r in range(start, stop):
+            for f in range(n_factors):
+                g = offsets[f] + codes[f, r]
+                chunk_sums[ch, g] += y[r]
+                chunk_counts[ch, g] += 1
+
+    sums = np.zeros(n_groups)
+    counts = np.zeros(n_groups, np.int64)
+    for ch in range(n_chunks):
+        for g in range(n_groups):
+            sums[g] += chunk_sums[ch, g]
+            counts[g] += chunk_counts[ch, g]
+    return sums, counts
+
+
+# Tukey HSD 两两比较核心计算（Tukey-Kramer，允许各组样本量不同）
+@njit(
+    "Tuple((i8[::1], i8[::1], f8[::1], f8[::1], f8[::1], f8[::1], b1[::1]))"
+    "(f8[:], f8[:], f8, f8)",
+    cache=True, fastmath=True
+)
+def tukey_kernel(means, counts, mse, q_crit):
+    k = len(means)
+    m = k * (k - 1) // 2
+    group1 = np.empty(m, np.int64)
+    group2 = np.empty(m, np.int64)
+    meandiffs = np.empty(m)
+    lower = np.empty(m)
+    upper = np.empty(m)
+    q_stat = np.empty(m)
+    reject = np.empty(m, np.bool_)
+    idx = 0
+    for i in range(k):
+        for j in range(i + 1, k):
+            diff = means[j] - means[i]
+            se = np.sqrt(mse / 2.0 * (1.0 / counts[i] + 1.0 / counts[j]))
+            group1[idx] = i
+            group2[idx] = j
+            meandiffs[idx] = diff
+            lower[idx] = diff - q_crit * se
+            upper[idx] = diff + q_crit * se
+            q_stat[idx] = abs(diff) / se
+            reject[idx] = q_stat[idx] > q_crit
+            idx += 1
+    return group1, group2, meandiffs, lower, upper, q_stat, reject